@@ -1,4 +1,4 @@
-#!/usr/bin/env python
+#!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 
 '''
@@ -25,18 +25,27 @@ in any manner to imply endorsement of any commercial product or activity
 by DOC or the United States Government.
 '''
 
-from __future__ import print_function
-
 import sys
 import os
 import os.path
+import stat
 
-from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor, as_completed
 import json
+import logging
 import re
+import shlex
 import subprocess
+import tempfile
+import threading
+import time
 import traceback
-import urllib2
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+log = logging.getLogger('ghorgsync')
 
 class GHOrgSync(object):
     '''
@@ -61,7 +70,11 @@ class GHOrgSync(object):
         https://help.github.com/articles/connecting-to-github-with-ssh/
     '''
 
-    def __init__(self, orgname, localdir, nameregex=r'[\w\.-]+'):
+    # fields of the GitHub API repository information used (and cached)
+    __REPOKEYS = ('name', 'private', 'has_wiki', 'ssh_url', 'git_url', 'fork', 'updated_at', 'pushed_at')
+
+    def __init__(self, orgname, localdir, nameregex=r'[\w\.-]+', shallow=True, perpage=100, 
+                 apijobs=16, cachedir=None, cachettl=3600, gitjobs=8, nowikittl=604800):
         '''
         Clone and update (pull) acceptable repositories at the given 
         GitHub organization site under the given local directory.
@@ -74,10 +87,172 @@ class GHOrgSync(object):
                               acceptable repository names; r'[\w\.-]+' allows 
                               one or more alphanumeric, underscore, period, 
                               and dash characters
+            shallow   : (bool) create new clones with only the most recent 
+                              commit of the default branch (no history or 
+                              tags), and keep shallow clones shallow when 
+                              updating them
+            perpage   : (int) number of repositories to request per page of 
+                              the GitHub API repository listing; GitHub 
+                              allows at most 100
+            apijobs   : (int) maximum number of concurrent GitHub API requests
+            cachedir  : (str) directory in which to cache the repository 
+                              listing of the organization between runs; 
+                              if None, no cache is used
+            cachettl  : (float) age, in seconds, under which the cached 
+                              repository listing is used without contacting 
+                              GitHub; an older listing is revalidated with 
+                              conditional (ETag) requests
+            gitjobs   : (int) maximum number of git commands run at the same 
+                              time, however many threads are synchronizing 
+                              repositories
+            nowikittl : (float) age, in seconds, after which a wiki found to 
+                              have no content is tried again
         '''
         self.__orgname = orgname;
-        self.__localdir = localdir
-        self.__nameregex = nameregex
+        self.__privatedir = os.path.join(localdir, 'private')
+        self.__publicdir = os.path.join(localdir, 'public')
+        # regex to check the SSH URL of a repository
+        self.__urlregex = re.compile(r'git@github\.com:{org}/({regex})\.git\Z'.format(
+                                     org=re.escape(orgname), regex=nameregex))
+        self.__shallow = shallow
+        self.__perpage = perpage
+        self.__apijobs = apijobs
+        self.__cachedir = cachedir
+        self.__cachettl = cachettl
+        self.__gitsem = threading.BoundedSemaphore(gitjobs)
+        # repositories known to have a wiki with no content, by directory
+        self.__nowikis = { }
+        self.__nowikittl = nowikittl
+        self.__nowikilock = threading.Lock()
+        # Single session so all GitHub API requests share pooled keep-alive 
+        # connections, retrying transient server errors
+        self.__session = requests.Session()
+        retries = Retry(total=5, backoff_factor=0.5, status_forcelist=[502, 503, 504])
+        self.__session.mount('https://', HTTPAdapter(pool_connections=1, pool_maxsize=apijobs, 
+                                                     max_retries=retries))
+        # authentication information
+        try:
+            token = os.getenv('GITUSERTOKEN', '').strip()
+        except Exception:
+            token = ''
+        self.__session.headers['Accept'] = 'application/vnd.github+json'
+        if token:
+            self.__session.headers['Authorization'] = 'token ' + token
+        self.__authenticated = bool(token)
+        # Environment for git commands: share one SSH connection to GitHub 
+        # among the git commands run close together, unless the user has 
+        # chosen how git runs SSH or there is no usable socket directory
+        self.__gitenv = os.environ.copy()
+        if not (self.__gitenv.get('GIT_SSH_COMMAND') or self.__gitenv.get('GIT_SSH')):
+            muxdir = self.__sshmuxdir()
+            if muxdir:
+                self.__gitenv['GIT_SSH_COMMAND'] = 'ssh -o ControlMaster=auto -o ControlPersist=60s ' \
+                                                   '-o ControlPath=' + shlex.quote(os.path.join(muxdir, '%C'))
+
+    def __sshmuxdir(self):
+        '''
+        Returns the directory for the SSH connection sharing sockets, 
+        creating it if needed, or None if it cannot be created or is not 
+        a private directory writable by the current user.  (SSH fails, 
+        rather than not sharing, if it cannot create the socket.)
+        '''
+        muxdir = os.path.join(tempfile.gettempdir(), 'ghorgsync-ssh-{0}'.format(os.getuid()))
+        try:
+            os.makedirs(muxdir, mode=0o700, exist_ok=True)
+            muxstat = os.stat(muxdir)
+        except OSError:
+            return None
+        if (muxstat.st_uid != os.getuid()) or (muxstat.st_mode & 0o077) or \
+           (not os.access(muxdir, os.W_OK | os.X_OK)):
+            return None
+        return muxdir
+
+    def __rungit(self, cmd, **kwargs):
+        '''
+        Runs the given git command (as a list), passing any keyword 
+        arguments to subprocess.run, and returns the completed process.  
+        Waits if the maximum number of git commands are already running.  
+        A non-zero return code is not an error here; callers check it.  
+        The command uses git wire protocol version 2, which advertises 
+        only the refs requested, and the SSH connection sharing settings.
+        '''
+        cmd = cmd[:1] + ['-c', 'protocol.version=2'] + cmd[1:]
+        with self.__gitsem:
+            return subprocess.run(cmd, check=False, env=self.__gitenv, **kwargs)
+
+    def __clonecmd(self, basedir, url):
+        '''
+        Returns the git command (as a list) for cloning the repository at 
+        the given URL into a subdirectory of the given directory, honoring 
+        the shallow setting of this instance.
+        '''
+        cmd = ['git', '-C', basedir, 'clone', '--quiet']
+        if self.__shallow:
+            cmd.extend(['--depth=1', '--no-tags', '--single-branch'])
+        cmd.append(url)
+        return cmd
+
+    def __updateclone(self, clonedir):
+        '''
+        Updates the existing local clone in the given directory.  A shallow 
+        clone is updated by fetching only the most recent commit and 
+        resetting to it, since pulling into a shallow clone gradually 
+        deepens it.  A full clone is updated with a regular pull.
+
+        Returns: (int) return value of the last git command run
+        '''
+        if self.__shallow and (self.__filetype(os.path.join(clonedir, '.git', 'shallow')) == stat.S_IFREG):
+            retval = self.__rungit(['git', '-C', clonedir, 'fetch', '--quiet', '--depth=1', 
+                                    '--no-tags', 'origin']).returncode
+            if retval == 0:
+                retval = self.__rungit(['git', '-C', clonedir, 'reset', '--quiet', '--hard', 
+                                        'FETCH_HEAD']).returncode
+            return retval
+        return self.__rungit(['git', '-C', clonedir, 'pull', '--quiet']).returncode
+
+    # file in the .git directory of a local clone recording the GitHub 
+    # pushed_at value of the repository when the clone was last updated
+    __PUSHEDATFILE = 'ghorgsync_pushed_at'
+
+    def __isuptodate(self, clonedir, pushedat):
+        '''
+        Returns whether the existing local clone in the given directory 
+        does not need to be updated.  If pushedat is given, compares it to 
+        the value recorded when the clone was last created or updated.  
+        Otherwise compares the HEAD of the clone to the HEAD of origin.
+        '''
+        if pushedat:
+            try:
+                with open(os.path.join(clonedir, '.git', self.__PUSHEDATFILE)) as pushedfile:
+                    return pushedfile.read().strip() == pushedat
+            except OSError:
+                return False
+        # Any failure here just means the clone is updated, which reports problems
+        remote = self.__rungit(['git', '-C', clonedir, 'ls-remote', 'origin', 'HEAD'], 
+                               stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+        if (remote.returncode != 0) or (not remote.stdout.split()):
+            return False
+        local = self.__rungit(['git', '-C', clonedir, 'rev-parse', 'HEAD'], 
+                              stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+        if (local.returncode != 0) or (not local.stdout.split()):
+            return False
+        return remote.stdout.split()[0] == local.stdout.split()[0]
+
+    def __writepushedat(self, clonedir, pushedat):
+        '''
+        Records the given pushed_at value in the local clone in the given 
+        directory, or removes any recorded value if pushedat is not given.
+        '''
+        pushedpath = os.path.join(clonedir, '.git', self.__PUSHEDATFILE)
+        try:
+            if pushedat:
+                with open(pushedpath, 'w') as pushedfile:
+                    pushedfile.write(pushedat + '\n')
+            else:
+                os.remove(pushedpath)
+        except OSError:
+            # only means the clone will be updated next time
+            pass
 
     def getrepos(self):
         '''
@@ -94,8 +269,14 @@ class GHOrgSync(object):
 
         Checks that the repository name matches the name regular expression.  
         Also checks the SSH URL is the expected URL for the organization and 
-        repository name.  An error message is printed to sys.stderr about any 
-        repositories that were ignored.
+        repository name.  An error message is logged (to the "ghorgsync" 
+        logger) about any repositories that were ignored.
+
+        If a cache directory was given, the repository listing is saved 
+        there.  A cached listing younger than the cache time-to-live is 
+        used without contacting GitHub; an older listing is revalidated 
+        page by page with conditional requests.  The parent URLs of forks 
+        are cached and only looked up again if the fork has been updated.
     
         Each entry is the list returned is a dictionary with key-value pairs: 
             'name'      : (str) repository name; e.g., PyFerret
@@ -107,71 +288,344 @@ class GHOrgSync(object):
             'parenturl' : (str) SSH URL of the parent GitHub repository, or
                                 an empty string if this repository is not
                                 a fork of another GitHub repository
+            'pushedat'  : (str) time of the last push to the repository, or 
+                                None if never pushed or if the cached listing 
+                                was used without contacting GitHub (so the 
+                                value may be out of date); e.g., 
+                                2018-03-01T17:42:08Z
         '''
+        # Get the info about all the repos at the organization that can be seen, 
+        # using the cached listing as-is if recent enough
+        pages, etags, parents, fetched = self.__readcache()
+        revalidated = (not pages) or ((time.time() - fetched) >= self.__cachettl)
+        if revalidated:
+            pages, etags = self.__getpages(pages, etags)
+            fetched = time.time()
         repos = [ ]
-        # regex to check the URL
-        urlregex = re.compile('git@github.com:{org}/({regex}).git'.format(
-                               org=self.__orgname, regex=self.__nameregex))
-        # authentication information
-        try:
-            token = os.getenv('GITUSERTOKEN', '').strip()
-        except Exception:
-            token = ''
-        # Get the info about all the repos at the organization that can be seen.
-        pagenum = 1
-        while pagenum >  0:
-            reposreq = urllib2.Request('https://api.github.com/orgs/{org}/repos?page={pnum}'.format(
-                                        org=self.__orgname, pnum=pagenum))
-            if token:
-                reposreq.add_header('Authorization', 'token ' + token)
-            conn = urllib2.urlopen(reposreq)
-            repolist = json.load(conn)
-            conn.close()
-            atend = True
+        forknames = [ ]
+        updated = { }
+        for repolist in pages:
             for repo in repolist:
-                atend = False
-                name = str(repo[u'name'])
-                private = bool(repo[u'private'])
-                haswiki = bool(repo[u'has_wiki'])
-                sshurl = str(repo[u'ssh_url'])
-                giturl = str(repo[u'git_url'])
-                match = urlregex.match(sshurl)
+                name = repo['name']
+                private = repo['private']
+                haswiki = repo['has_wiki']
+                sshurl = repo['ssh_url']
+                giturl = repo['git_url']
+                match = self.__urlregex.match(sshurl)
                 if match and (match.group(1) == name):
-                    if bool(repo[u'fork']):
-                        inforeq = urllib2.Request('https://api.github.com/repos/{org}/{rname}'.format(
-                                                   org=self.__orgname, rname=name))
-                        if token:
-                            inforeq.add_header('Authorization', 'token ' + token)
-                        conn = urllib2.urlopen(inforeq)
-                        repoinfo = json.load(conn)
-                        conn.close()
-                        parenturl = str(repoinfo[u'parent'][u'ssh_url'])
-                    else:
-                        parenturl = ''
+                    if repo['fork']:
+                        forknames.append(name)
+                        updated[name] = repo['updated_at']
                     repos.append({'name': name, 
                                   'private': private, 
                                   'haswiki': haswiki, 
                                   'sshurl': sshurl,
                                   'giturl': giturl,
-                                  'parenturl': parenturl})
+                                  'parenturl': '',
+                                  'pushedat': repo['pushed_at'] if revalidated else None})
                 else:
-                    timestamp = datetime.today().isoformat(' ')
                     if not match:
                         explanation = 'no match'
                     else:
                         explanation = 'mismatch'
-                    print('{ts} :: repo ignored ({expl}) {rname} : {url}'.format(
-                          ts=timestamp, expl=explanation, rname=name, url=sshurl), file=sys.stderr)
-            if atend:
-                pagenum = 0
+                    log.error('repo ignored (%s) %s : %s', explanation, name, sshurl)
+        # Get the parent URL of each fork not updated since its parent URL was cached
+        parents = dict( (name, parents[name]) for name in forknames 
+                        if (name in parents) and (parents[name]['updated_at'] == updated[name]) )
+        newforks = [ name for name in forknames if name not in parents ]
+        if newforks:
+            parenturls = self.__getparenturls(newforks)
+            for name in newforks:
+                parents[name] = {'updated_at': updated[name], 'parenturl': parenturls[name]}
+        for repo in repos:
+            if repo['name'] in parents:
+                repo['parenturl'] = parents[repo['name']]['parenturl']
+        self.__writecache(pages, etags, parents, fetched)
+        return repos
+
+    # maximum number of times a GitHub API request is repeated after waiting 
+    # for a rate limit to reset
+    __RATELIMITRETRIES = 3
+
+    def __apirequest(self, method, url, **kwargs):
+        '''
+        Makes a GitHub API request using the shared session, passing any 
+        keyword arguments to the session request, and returns the response.  
+        If GitHub refuses the request because a rate limit was exceeded, 
+        waits as directed by the Retry-After header, or until the rate 
+        limit resets, and repeats the request.  If the response shows the 
+        rate limit is used up, waits until it resets before returning, 
+        rather than have the next request refused.
+        '''
+        attempt = 0
+        while True:
+            resp = self.__session.request(method, url, timeout=30, **kwargs)
+            exhausted = (resp.headers.get('X-RateLimit-Remaining') == '0')
+            if (resp.status_code not in (403, 429)) or (attempt >= self.__RATELIMITRETRIES):
+                break
+            if resp.headers.get('Retry-After') or exhausted:
+                self.__waitratelimit(self.__ratelimitreset(resp))
             else:
+                # refused for some other reason
+                break
+            attempt += 1
+        if exhausted and resp.ok:
+            self.__waitratelimit(self.__ratelimitreset(resp))
+        return resp
+
+    def __ratelimitreset(self, resp):
+        '''
+        Returns the number of seconds to wait for the GitHub API rate limit 
+        in the given response: the Retry-After value if given (secondary 
+        rate limits), otherwise the time until the X-RateLimit-Reset time.
+        '''
+        try:
+            if resp.headers.get('Retry-After'):
+                return float(resp.headers['Retry-After'])
+            return float(resp.headers['X-RateLimit-Reset']) - time.time()
+        except (KeyError, ValueError):
+            return 60.0
+
+    def __waitratelimit(self, seconds):
+        '''
+        Waits the given number of seconds (plus one for clock differences) 
+        for a GitHub API rate limit, logging a message about it.
+        '''
+        seconds = max(seconds, 0.0) + 1.0
+        log.warning('GitHub API rate limit reached; waiting %d seconds', seconds)
+        time.sleep(seconds)
+
+    def __getpages(self, cachedpages, cachedetags):
+        '''
+        Returns the pages of the GitHub API repository listing of the 
+        organization specified by this instance, and the ETag of each page.  
+        Each page is a list of dictionaries with only the fields of the 
+        repository information used by getrepos.  Pages with a cached 
+        ETag are requested conditionally and, if unchanged, the cached 
+        page is used.
+
+        Arguments:
+            cachedpages : (list) cached pages, or an empty list
+            cachedetags : (list) ETag of each cached page
+        Returns: (list, list) pages and ETags
+        '''
+        pages = [ ]
+        etags = [ ]
+        pagenum = 1
+        while pagenum > 0:
+            headers = { }
+            if (pagenum <= len(cachedpages)) and cachedetags[pagenum - 1]:
+                headers['If-None-Match'] = cachedetags[pagenum - 1]
+            resp = self.__apirequest('GET', 'https://api.github.com/orgs/{org}/repos?per_page={psize}&page={pnum}'.format(
+                                      org=self.__orgname, psize=self.__perpage, pnum=pagenum), 
+                                     headers=headers)
+            if resp.status_code == 304:
+                # Not modified - reuse the cached page
+                pages.append(cachedpages[pagenum - 1])
+                etags.append(cachedetags[pagenum - 1])
+                # A 304 response may not have a Link header, so also go on if 
+                # more pages were cached or this page was full (in which case 
+                # repositories may have been added on a following page)
+                morepages = ('next' in resp.links) or (pagenum < len(cachedpages)) or \
+                            (len(cachedpages[pagenum - 1]) >= self.__perpage)
+            else:
+                resp.raise_for_status()
+                pages.append(resp.json(object_hook=self.__slimrepo))
+                etags.append(resp.headers.get('ETag', ''))
+                # The Link header gives the next page only if there is one
+                morepages = ('next' in resp.links)
+            if morepages:
                 pagenum += 1
-        return repos
+            else:
+                pagenum = 0
+        return pages, etags
+
+    def __slimrepo(self, obj):
+        '''
+        JSON object hook keeping only the fields of the repository information 
+        used by getrepos, so the unused parts of each page (owner, permissions, 
+        dozens of API URLs, etc.) are discarded as soon as they are parsed.  
+        Nested objects are reduced to the same fields and then dropped.
+        '''
+        return dict( (key, obj[key]) for key in self.__REPOKEYS if key in obj )
+
+    def __cachepaths(self):
+        '''
+        Returns the paths of the cached repository listing file and of 
+        its metadata file for the organization specified by this instance.
+        '''
+        basename = os.path.join(self.__cachedir, self.__orgname)
+        return basename + '.json', basename + '.meta.json'
+
+    def __readcache(self):
+        '''
+        Returns the cached pages of the repository listing, their ETags, 
+        the cached fork parent information, and the time (seconds since 
+        the epoch) the listing was fetched.  If there is no usable cache, 
+        empty values are returned.
+        '''
+        if self.__cachedir:
+            listpath, metapath = self.__cachepaths()
+            try:
+                with open(metapath) as metafile:
+                    meta = json.load(metafile)
+                # The listing depends on the page size and authentication
+                if (meta['perpage'] == self.__perpage) and \
+                   (meta['authenticated'] == self.__authenticated) and \
+                   (meta['repokeys'] == list(self.__REPOKEYS)):
+                    with open(listpath) as listfile:
+                        listing = json.load(listfile)
+                    # Both files must come from the same run
+                    if (listing['fetched'] == meta['fetched']) and \
+                       (len(listing['pages']) == len(meta['etags'])):
+                        return listing['pages'], meta['etags'], listing['parents'], meta['fetched']
+            except (OSError, ValueError, KeyError, TypeError):
+                pass
+        return [ ], [ ], { }, 0.0
+
+    def __writecache(self, pages, etags, parents, fetched):
+        '''
+        Saves the pages of the repository listing, their ETags, the fork 
+        parent information, and the time the listing was fetched.  Failing 
+        to save is logged but is not an error.
+        '''
+        if not self.__cachedir:
+            return
+        listpath, metapath = self.__cachepaths()
+        try:
+            os.makedirs(self.__cachedir, exist_ok=True)
+            # The fetch time in both files identifies which run wrote them
+            self.__replacejson(listpath, {'fetched': fetched, 
+                                          'pages': pages, 
+                                          'parents': parents})
+            self.__replacejson(metapath, {'fetched': fetched, 
+                                          'etags': etags, 
+                                          'perpage': self.__perpage, 
+                                          'authenticated': self.__authenticated, 
+                                          'repokeys': list(self.__REPOKEYS)})
+        except OSError as ex:
+            log.error('cannot write cache %s : %s', listpath, ex)
+
+    def __replacejson(self, path, value):
+        '''
+        Writes the given value as JSON to a temporary file in the directory 
+        of the given path and then replaces the file at the path with it, 
+        so the file is never seen partially written.
+        '''
+        (fd, temppath) = tempfile.mkstemp(dir=os.path.dirname(path), 
+                                          prefix=os.path.basename(path) + '.')
+        try:
+            with os.fdopen(fd, 'w') as jsonfile:
+                json.dump(value, jsonfile)
+            os.replace(temppath, path)
+        except BaseException:
+            os.remove(temppath)
+            raise
+
+    # maximum number of repositories queried in one GitHub GraphQL request
+    __GRAPHQLBATCH = 100
+
+    def __getparenturls(self, names):
+        '''
+        Returns a dictionary mapping each of the given fork names to the 
+        SSH URL of the parent GitHub repository.  If authenticated, the 
+        parent URLs are queried in batches with the GitHub GraphQL API.  
+        Any not obtained that way are requested individually (and 
+        concurrently) with the GitHub REST API.
+        '''
+        parenturls = { }
+        # The GraphQL API can only be used with authentication
+        if self.__authenticated:
+            for start in range(0, len(names), self.__GRAPHQLBATCH):
+                parenturls.update(self.__queryparenturls(names[start:start + self.__GRAPHQLBATCH]))
+        missing = [ name for name in names if name not in parenturls ]
+        if missing:
+            # these requests are independent so overlap their round-trips
+            with ThreadPoolExecutor(max_workers=self.__apijobs) as executor:
+                parenturls.update(zip(missing, executor.map(self.__getparenturl, missing)))
+        return parenturls
+
+    def __queryparenturls(self, names):
+        '''
+        Returns a dictionary mapping the given fork names to the SSH URL 
+        of the parent GitHub repository, obtained with a single GitHub 
+        GraphQL API request.  Names whose parent URL could not be obtained 
+        are omitted; if the request fails, an empty dictionary is returned.
+        '''
+        owner = json.dumps(self.__orgname)
+        query = 'query { ' + ' '.join( 
+                    'r{num}: repository(owner: {owner}, name: {rname}) {{ parent {{ sshUrl }} }}'.format(
+                    num=num, owner=owner, rname=json.dumps(name)) for (num, name) in enumerate(names) 
+                ) + ' }'
+        try:
+            resp = self.__apirequest('POST', 'https://api.github.com/graphql', json={'query': query})
+            resp.raise_for_status()
+            data = resp.json().get('data') or { }
+        except (requests.RequestException, ValueError, AttributeError) as ex:
+            log.info('GraphQL query of fork parents failed, using REST : %s', ex)
+            return { }
+        parenturls = { }
+        for (num, name) in enumerate(names):
+            repoinfo = data.get('r{num}'.format(num=num))
+            if repoinfo and repoinfo.get('parent'):
+                parenturls[name] = repoinfo['parent']['sshUrl']
+        return parenturls
+
+    def __getparenturl(self, name):
+        '''
+        Returns the SSH URL of the parent GitHub repository of the fork 
+        with the given name in the organization specified by this instance.
+        '''
+        resp = self.__apirequest('GET', 'https://api.github.com/repos/{org}/{rname}'.format(
+                                  org=self.__orgname, rname=name))
+        resp.raise_for_status()
+        repoinfo = resp.json()
+        return repoinfo['parent']['ssh_url']
 
     def syncrepo(self, repo):
+        '''
+        Create or update (pull) a local clone of the given repository, 
+        and of its wiki if it has one.  Equivalent to calling syncclone 
+        and then syncwiki.  If a problem occurs, a message is logged 
+        (to the "ghorgsync" logger).
+
+        Arguments:
+            repo : (dict) repository information dictionary; see syncclone 
+                          and syncwiki
+        Returns: (bool) if successful
+        '''
+        if not self.syncclone(repo):
+            return False
+        return self.syncwiki(repo)
+
+    def __basedir(self, repo):
+        '''
+        Returns the local directory containing the clone of the given 
+        repository (dictionary) and the clone of its wiki.
+        '''
+        if repo['private']:
+            return self.__privatedir
+        return self.__publicdir
+
+    def __filetype(self, path):
+        '''
+        Returns the file type bits (e.g., stat.S_IFDIR) of the given path, 
+        or None if it does not exist, using a single stat call.  If the 
+        path cannot be examined (e.g., no search permission), returns 0, 
+        which matches no file type, so callers report the path as a problem 
+        rather than treating it as missing.
+        '''
+        try:
+            return stat.S_IFMT(os.stat(path).st_mode)
+        except FileNotFoundError:
+            return None
+        except OSError:
+            return 0
+
+    def syncclone(self, repo):
         '''
         Create or update (pull) a local clone of the given repository.
-        If a problem occurs, a message is printed to sys.stderr
+        If a problem occurs, a message is logged (to the "ghorgsync" logger).
 
         Arguments:
             repo : (dict) repository information dictionary with key-value pairs: 
@@ -185,6 +639,12 @@ class GHOrgSync(object):
                                     as the upstream repository when creating the 
                                     local clone.  If empty or None, or if the local 
                                     clone already exists, this value is ignored.
+                'pushedat'  : (str) time of the last push to the repository.  If 
+                                    given and the same as when the local clone was 
+                                    last created or updated, the local clone is not 
+                                    updated.  If missing or None, the local clone is 
+                                    not updated if its HEAD matches the HEAD of the 
+                                    GitHub repository.
         Returns: (bool) if successful
         '''
         # Get the info about the repo
@@ -193,102 +653,155 @@ class GHOrgSync(object):
         sshurl = repo['sshurl']
         giturl = repo['giturl']
         parenturl = repo['parenturl']
+        pushedat = repo.get('pushedat')
         # Get the local clone location for this repo
-        if private:
-            basedir = os.path.join(self.__localdir, 'private')
-        else:
-            basedir = os.path.join(self.__localdir, 'public')
+        basedir = self.__basedir(repo)
         clonedir = os.path.join(basedir, name)
         # Deal with this repo
-        if not os.path.exists(clonedir):
+        clonetype = self.__filetype(clonedir)
+        if clonetype is None:
             cloneurl = sshurl
             if not private:
                 # use Git protocol for public repos, per GitHub docs
                 cloneurl = giturl
             # New repo - clone it
-            os.chdir(basedir)
-            retval = subprocess.call(['git', 'clone', '--quiet', cloneurl])
+            retval = self.__rungit(self.__clonecmd(basedir, cloneurl)).returncode
             if retval != 0:
-                timestamp = datetime.today().isoformat(' ')
-                print('{ts} :: cannot clone repository {rname} : {url}'.format(
-                       ts=timestamp, rname=name, url=cloneurl), file=sys.stderr)
+                log.error('cannot clone repository %s : %s', name, cloneurl)
                 return False
             if parenturl:
                 # Fork - record its upstream
-                os.chdir(clonedir)
-                retval = subprocess.call(['git', 'remote', 'add', 'upstream', parenturl])
+                retval = self.__rungit(['git', '-C', clonedir, 'remote', 'add', 'upstream', 
+                                        parenturl]).returncode
                 if retval != 0:
-                    timestamp = datetime.today().isoformat(' ')
-                    print('{ts} :: cannot add to {rname} the upstream {url}'.format(
-                           ts=timestamp, rname=name, url=parenturl), file=sys.stderr)
+                    log.error('cannot add to %s the upstream %s', name, parenturl)
                     return False
-        elif os.path.isdir(clonedir):
+            self.__writepushedat(clonedir, pushedat)
+        elif clonetype == stat.S_IFDIR:
             # Verify it is a git repo
-            dotgit = os.path.join(clonedir, '.git')
-            if os.path.isdir(dotgit):
-                # Existing local clone - update it (pull)
-                os.chdir(clonedir)
-                retval = subprocess.call(['git', 'pull', '--quiet'])
-                if retval != 0:
-                    timestamp = datetime.today().isoformat(' ')
-                    print('{ts} :: cannot update (pull) repository {rname}'.format(
-                           ts=timestamp, rname=name), file=sys.stderr)
-                    return False
+            if self.__filetype(os.path.join(clonedir, '.git')) == stat.S_IFDIR:
+                # Existing local clone - update it (pull) if there has been a push since
+                if not self.__isuptodate(clonedir, pushedat):
+                    retval = self.__updateclone(clonedir)
+                    if retval != 0:
+                        log.error('cannot update (pull) repository %s', name)
+                        return False
+                    self.__writepushedat(clonedir, pushedat)
             else:
-                timestamp = datetime.today().isoformat(' ')
-                print('{ts} :: not a git repository: {dname}'.format(
-                       ts=timestamp, dname=clonedir), file=sys.stderr)
+                log.error('not a git repository: %s', clonedir)
                 return False
         else:
             # Not a directory
-            timestamp = datetime.today().isoformat(' ')
-            print('{ts} :: not a directory: {dname}'.format(
-                   ts=timestamp, dname=clonedir), file=sys.stderr)
+            log.error('not a directory: %s', clonedir)
             return False
-        # Deal with the wiki of this repo, if there is one.
-        if repo['haswiki']:
-            # Assumes wiki name is repo name with '.wiki' appended
-            wikiname = name + '.wiki'
-            wikidir = os.path.join(basedir, wikiname)
-            if not os.path.exists(wikidir):
-                wikiurl = sshurl[:-4] + '.wiki.git'
-                # New wiki - clone it
-                # Unfortunately, has_wiki only means a wiki is allowed and 
-                # does not mean there actually is any content.  If no content, 
-                # an error message and error value is returned.
-                os.chdir(basedir)
-                devnull = open('/dev/null', 'w')
-                try:
-                    retval = subprocess.call(['git', 'clone', '--quiet', wikiurl], stderr=devnull)
-                finally:
-                    devnull.close()
-                # Ignore the error value
-            elif os.path.isdir(wikidir):
-                # Verify it is a git repo
-                dotgit = os.path.join(wikidir, '.git')
-                if os.path.isdir(dotgit):
-                    # Existing local clone - update it (pull)
-                    os.chdir(wikidir)
-                    retval = subprocess.call(['git', 'pull', '--quiet'])
-                    if retval != 0:
-                        timestamp = datetime.today().isoformat(' ')
-                        print('{ts} :: cannot update (pull) wiki {wname}'.format(
-                               ts=timestamp, wname=wikiname), file=sys.stderr)
-                        return False
-                else:
-                    timestamp = datetime.today().isoformat(' ')
-                    print('{ts} :: not a git repository: {dname}'.format(
-                           ts=timestamp, dname=wikidir), file=sys.stderr)
+        return True
+
+    # file in each of the private and public directories recording when 
+    # the wiki of a repository was found to have no content
+    __NOWIKIFILE = '.ghorgsync-nowiki'
+
+    def __nowikitimes(self, basedir):
+        '''
+        Returns a dictionary mapping the names of repositories whose wiki 
+        was found to have no content, as recorded in the given directory, 
+        to when (seconds since the epoch) it was found.  Must be called 
+        with the no-wiki lock held.
+        '''
+        nowikis = self.__nowikis.get(basedir)
+        if nowikis is None:
+            try:
+                with open(os.path.join(basedir, self.__NOWIKIFILE)) as nowikifile:
+                    nowikis = dict( (str(name), float(found)) 
+                                    for (name, found) in json.load(nowikifile).items() )
+            except (OSError, ValueError, AttributeError, TypeError):
+                nowikis = { }
+            self.__nowikis[basedir] = nowikis
+        return nowikis
+
+    def __writenowikitimes(self, basedir):
+        '''
+        Saves the no-content wiki records for the given directory, first 
+        dropping expired records, so names of deleted or renamed repositories 
+        do not accumulate.  Must be called with the no-wiki lock held.
+        '''
+        nowikis = self.__nowikitimes(basedir)
+        now = time.time()
+        for name in [ name for (name, found) in nowikis.items() 
+                      if (now - found) >= self.__nowikittl ]:
+            del nowikis[name]
+        try:
+            self.__replacejson(os.path.join(basedir, self.__NOWIKIFILE), nowikis)
+        except OSError:
+            # only means the wiki will be tried again next time
+            pass
+
+    def syncwiki(self, repo):
+        '''
+        Create or update (pull) a local clone of the wiki of the given 
+        repository, if it has one.  Wikis found to have no content when 
+        cloning are recorded in the file .ghorgsync-nowiki in the private 
+        or public directory and are not tried again until the record is 
+        older than the no-wiki time-to-live.  If a problem occurs, a message 
+        is logged (to the "ghorgsync" logger).
+
+        Arguments:
+            repo : (dict) repository information dictionary with key-value pairs: 
+                'name'      : (str) repository name; e.g., PyFerret
+                'private'   : (bool) is this a private repository?
+                'haswiki'   : (bool) are wikis enabled for this repository?
+                'sshurl'    : (str) SSH URL of the repository; e.g., 
+                                    git@github.com:NOAA-PMEL/PyFerret.git
+        Returns: (bool) if successful; True if there is no wiki
+        '''
+        if not repo['haswiki']:
+            return True
+        name = repo['name']
+        basedir = self.__basedir(repo)
+        # Assumes wiki name is repo name with '.wiki' appended
+        wikiname = name + '.wiki'
+        wikidir = os.path.join(basedir, wikiname)
+        wikitype = self.__filetype(wikidir)
+        if wikitype is None:
+            with self.__nowikilock:
+                found = self.__nowikitimes(basedir).get(name)
+            if (found is not None) and ((time.time() - found) < self.__nowikittl):
+                log.info('wiki %s skipped : found to have no content %s', wikiname, 
+                         time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(found)))
+                return True
+            wikiurl = repo['sshurl'][:-4] + '.wiki.git'
+            # New wiki - clone it
+            # Unfortunately, has_wiki only means a wiki is allowed and 
+            # does not mean there actually is any content.  If no content, 
+            # an error message and error value is returned.
+            proc = self.__rungit(self.__clonecmd(basedir, wikiurl), stdout=subprocess.DEVNULL, 
+                                 stderr=subprocess.PIPE, universal_newlines=True)
+            # Ignore the error value, but remember wikis with no content
+            if (proc.returncode != 0) and ('not found' in proc.stderr.lower()):
+                with self.__nowikilock:
+                    self.__nowikitimes(basedir)[name] = time.time()
+                    self.__writenowikitimes(basedir)
+            elif found is not None:
+                # expired record no longer needed
+                with self.__nowikilock:
+                    self.__nowikitimes(basedir).pop(name, None)
+                    self.__writenowikitimes(basedir)
+        elif wikitype == stat.S_IFDIR:
+            # Verify it is a git repo
+            if self.__filetype(os.path.join(wikidir, '.git')) == stat.S_IFDIR:
+                # Existing local clone - update it (pull)
+                retval = self.__updateclone(wikidir)
+                if retval != 0:
+                    log.error('cannot update (pull) wiki %s', wikiname)
                     return False
             else:
-                # Not a directory
-                timestamp = datetime.today().isoformat(' ')
-                print('{ts} :: not a directory: {dname}'.format(
-                       ts=timestamp, dname=wikidir), file=sys.stderr)
+                log.error('not a git repository: %s', wikidir)
                 return False
+        else:
+            # Not a directory
+            log.error('not a directory: %s', wikidir)
+            return False
         return True
 
-
 if __name__ == '__main__':
     if len(sys.argv) != 3:
         print("\n" + \
@@ -301,21 +814,61 @@ if __name__ == '__main__':
               "        localdir  is the full-path of the directory containing a 'private'\n" + \
               "                  and a 'public' subdirectory which will contain the cloned\n" + \
               "                  private and public, respectively, repository subdirectories\n" + \
+              "\n" + \
+              "    The environment variable GHORGSYNC_JOBS, if given, sets the number of\n" + \
+              "    repositories synchronized concurrently (default 8).  If the environment\n" + \
+              "    variable GHORGSYNC_SHALLOW is given with the value 0, new clones contain\n" + \
+              "    the full history instead of only the most recent commit.  The repository\n" + \
+              "    listing is cached under ~/.cache/ghorgsync and reused without contacting\n" + \
+              "    GitHub for GHORGSYNC_CACHE_TTL seconds (default 3600).  At most\n" + \
+              "    GHORGSYNC_GIT_JOBS git commands (default 8) are run at the same time.\n" + \
+              "    Wikis found to have no content are not tried again for\n" + \
+              "    GHORGSYNC_NOWIKI_TTL seconds (default 604800).\n" + \
               "\n", file=sys.stderr)
         sys.exit(1)
     orgname = sys.argv[1]
     localdir = sys.argv[2]
+    logging.basicConfig(stream=sys.stderr, format='%(asctime)s :: %(message)s')
+    # number of repositories to synchronize concurrently
+    try:
+        numjobs = int(os.getenv('GHORGSYNC_JOBS', '8'))
+    except ValueError:
+        numjobs = 8
+    if numjobs < 1:
+        numjobs = 1
     retval = 0
     try:
-        cloner = GHOrgSync(orgname, localdir)
+        shallow = (os.getenv('GHORGSYNC_SHALLOW', '1').strip() != '0')
+        cachedir = os.path.join(os.getenv('XDG_CACHE_HOME', '').strip() or 
+                                os.path.join(os.path.expanduser('~'), '.cache'), 'ghorgsync')
+        try:
+            cachettl = float(os.getenv('GHORGSYNC_CACHE_TTL', '3600'))
+        except ValueError:
+            cachettl = 3600.0
+        try:
+            gitjobs = max(int(os.getenv('GHORGSYNC_GIT_JOBS', '8')), 1)
+        except ValueError:
+            gitjobs = 8
+        try:
+            nowikittl = float(os.getenv('GHORGSYNC_NOWIKI_TTL', '604800'))
+        except ValueError:
+            nowikittl = 604800.0
+        cloner = GHOrgSync(orgname, localdir, shallow=shallow, cachedir=cachedir, cachettl=cachettl, 
+                           gitjobs=gitjobs, nowikittl=nowikittl)
         repos = cloner.getrepos()
         if len(repos) < 1:
-            timestamp = datetime.today().isoformat(' ')
-            print('{ts} :: no repositories found for {site}'.format(ts=timestamp, site=orgname), file=sys.stderr)
+            log.error('no repositories found for %s', orgname)
             sys.exit(2)
-        for repoinfo in repos:
-            if not cloner.syncrepo(repoinfo):
-                retval = 3
+        with ThreadPoolExecutor(max_workers=numjobs) as executor:
+            # the clones of a repository and of its wiki are independent
+            futures = [ ]
+            for repoinfo in repos:
+                futures.append(executor.submit(cloner.syncclone, repoinfo))
+                if repoinfo['haswiki']:
+                    futures.append(executor.submit(cloner.syncwiki, repoinfo))
+            for future in as_completed(futures):
+                if not future.result():
+                    retval = 3
     except Exception:
         traceback.print_exc()
         sys.exit(-1)